@@ -129,19 +129,41 @@ def transform_point_cloud(input_laz, a_matrix, output_laz):
         },
         output_laz,
     ]
-    p = pdal.Pipeline(json.dumps(pipe))
-    p.execute()
-
-def transform_obj(input_obj, a_matrix, geo_offset, output_obj):
+    # The transformation is point-wise, so stream the cloud
+    # in chunks instead of loading it all in memory
+    try:
+        p = pdal.Pipeline(json.dumps(pipe))
+        p.execute_streaming(chunk_size=1000000)
+    except Exception as e:
+        log.ODM_WARNING("Cannot transform point cloud in stream mode (%s), falling back to standard mode" % str(e))
+        p = pdal.Pipeline(json.dumps(pipe))
+        p.execute()
+
+def transform_obj(input_obj, a_matrix, geo_offset, output_obj, block_size=1000000):
     g_off = np.array([geo_offset[0], geo_offset[1], 0, 0])
 
+    def write_block(lines, fout):
+        # Transform the vertices of this block with a single matrix product
+        v_idx = [i for i, line in enumerate(lines) if line.startswith("v ")]
+        if len(v_idx) > 0:
+            values = [lines[i][2:].split() for i in v_idx]
+            v = np.ones((len(v_idx), 4), dtype=float)
+            v[:, :3] = np.array([val[:3] for val in values], dtype=float)
+            vt = ((v + g_off).dot(a_matrix.T) - g_off)[:, :3]
+
+            # Keep any extra components (w, vertex colors) as-is
+            for i, row, val in zip(v_idx, vt, values):
+                lines[i] = "v " + " ".join(map(str, list(row)) + val[3:]) + '\n'
+
+        fout.writelines(lines)
+
+    # Process the model in blocks of lines to keep memory usage bounded
     with open(input_obj, 'r') as fin:
         with open(output_obj, 'w') as fout:
-            lines = fin.readlines()
-            for line in lines:
-                if line.startswith("v "):
-                    v = np.fromstring(line.strip()[2:] + " 1",  sep=' ', dtype=float)
-                    vt = (a_matrix.dot((v + g_off)) - g_off)[:3]
-                    fout.write("v " + " ".join(map(str, list(vt))) + '\n')
-                else:
-                    fout.write(line)
\ No newline at end of file
+            block = []
+            for line in fin:
+                block.append(line)
+                if len(block) >= block_size:
+                    write_block(block, fout)
+                    block = []
+            write_block(block, fout)
@@ -4,6 +4,7 @@ from opendm import log
 from opendm.point_cloud import export_summary_json
 from osgeo import ogr
 import json, os
+import pdal
 from opendm.concurrency import get_max_memory
 from opendm.utils import double_quote
 
@@ -132,30 +133,31 @@ class Cropper:
             log.ODM_WARNING('Point cloud does not exist, cannot generate bounds {}'.format(pointcloud_path))
             return ''
 
-        # Do decimation prior to extracting boundary information
-        decimated_pointcloud_path = self.path('decimated.las')
+        # Decimate and extract boundary information in a single
+        # streamed PDAL pipeline, without writing the decimated
+        # point cloud to disk and reading it back
+        pipe = json.dumps([
+            pointcloud_path,
+            {
+                'type': 'filters.decimation',
+                'step': decimation_step,
+            },
+            {
+                'type': 'filters.hexbin',
+                'edge_size': 1,
+                'threshold': 0,
+            },
+        ])
 
-        run("pdal translate -i \"{}\" "
-            "-o \"{}\" "
-            "decimation "
-            "--filters.decimation.step={} ".format(pointcloud_path, decimated_pointcloud_path, decimation_step))
-
-        if not os.path.exists(decimated_pointcloud_path):
-            log.ODM_WARNING('Could not decimate point cloud, thus cannot generate GPKG bounds {}'.format(decimated_pointcloud_path))
-            return ''
-
-        # Use PDAL to dump boundary information
-        # then read the information back
-
-        boundary_file_path = self.path('boundary.json')
-
-        run('pdal info --boundary --filters.hexbin.edge_size=1 --filters.hexbin.threshold=0 "{0}" > "{1}"'.format(decimated_pointcloud_path,  boundary_file_path))
-        
-        pc_geojson_boundary_feature = None
+        try:
+            pipeline = pdal.Pipeline(pipe)
+            pipeline.execute_streaming(chunk_size=1000000)
+        except Exception as e:
+            log.ODM_WARNING("Cannot compute boundary in stream mode (%s), falling back to standard mode" % str(e))
+            pipeline = pdal.Pipeline(pipe)
+            pipeline.execute()
 
-        with open(boundary_file_path, 'r') as f:
-            json_f = json.loads(f.read())
-            pc_geojson_boundary_feature = json_f['boundary']['boundary_json']
+        pc_geojson_boundary_feature = pipeline.metadata["metadata"]["filters.hexbin"].get('boundary_json')
 
         if pc_geojson_boundary_feature is None: raise RuntimeError("Could not determine point cloud boundaries")
 
@@ -217,10 +219,6 @@ class Cropper:
         # Save and close data sources
         out_ds = ds = None
 
-        # Remove decimated point cloud
-        if os.path.exists(decimated_pointcloud_path):
-            os.remove(decimated_pointcloud_path)
-        
         # Remove tmp bounds
         if os.path.exists(tmp_bounds_geojson_path):
             os.remove(tmp_bounds_geojson_path)
@@ -1,21 +1,20 @@
 import os
 import shutil
 import struct
-import pipes
+import hashlib
 import fiona
 import fiona.crs
 import json
 import zipfile
 import math
 from collections import OrderedDict
-from pyproj import CRS
+from pyproj import CRS, Transformer
 
 from opendm import io
 from opendm import log
 from opendm import types
 from opendm import system
 from opendm import context
-from opendm import location
 from opendm.cropper import Cropper
 from opendm import point_cloud
 from opendm.multispectral import get_primary_band_name
@@ -29,6 +28,18 @@ class ODMGeoreferencingStage(types.ODM_Stage):
         tree = outputs['tree']
         reconstruction = outputs['reconstruction']
 
+        # Export the SRS to a PROJ string only once
+        proj4 = reconstruction.georef.proj4() if reconstruction.is_georeferenced() else None
+
+        # List the stage outputs once; only valid for
+        # files that this stage has not written yet
+        existing_outputs = set()
+        if io.dir_exists(tree.odm_georeferencing):
+            with os.scandir(tree.odm_georeferencing) as it:
+                existing_outputs = set([entry.name for entry in it if entry.is_file()])
+        def output_exists(path):
+            return os.path.basename(path) in existing_outputs
+
         # Export GCP information if available
 
         gcp_export_file = tree.path("odm_georeferencing", "ground_control_points.gpkg")
@@ -36,89 +47,123 @@ class ODMGeoreferencingStage(types.ODM_Stage):
         gcp_geojson_export_file = tree.path("odm_georeferencing", "ground_control_points.geojson")
         gcp_geojson_zip_export_file = tree.path("odm_georeferencing", "ground_control_points.zip")
         unaligned_model = io.related_file_path(tree.odm_georeferencing_model_laz, postfix="_unaligned")
-        if os.path.isfile(unaligned_model) and self.rerun():
+        if output_exists(unaligned_model) and self.rerun():
             os.unlink(unaligned_model)
+            existing_outputs.discard(os.path.basename(unaligned_model))
 
-        if reconstruction.has_gcp() and (not io.file_exists(gcp_export_file) or self.rerun()):
+        if reconstruction.has_gcp() and (not output_exists(gcp_export_file) or self.rerun()):
             octx = OSFMContext(tree.opensfm)
-            gcps = octx.ground_control_points(reconstruction.georef.proj4())
+            gcps = octx.ground_control_points(proj4)
 
             if len(gcps):
-                gcp_schema = {
-                    'geometry': 'Point',
-                    'properties': OrderedDict([
-                        ('id', 'str'),
-                        ('observations_count', 'int'),
-                        ('observations_list', 'str'),
-                        ('error_x', 'float'),
-                        ('error_y', 'float'),
-                        ('error_z', 'float'),
-                    ])
-                }
-
-                # Write GeoPackage
-                with fiona.open(gcp_export_file, 'w', driver="GPKG",
-                                crs=fiona.crs.from_string(reconstruction.georef.proj4()),
-                                schema=gcp_schema) as f:
-                    for gcp in gcps:
-                        f.write({
-                            'geometry': {
-                                'type': 'Point',
-                                'coordinates': gcp['coordinates'],
-                            },
-                            'properties': OrderedDict([
-                                ('id', gcp['id']),
-                                ('observations_count', len(gcp['observations'])),
-                                ('observations_list', ",".join([obs['shot_id'] for obs in gcp['observations']])),
-                                ('error_x', gcp['error'][0]),
-                                ('error_y', gcp['error'][1]),
-                                ('error_z', gcp['error'][2]),
-                            ])
-                        })
+                # Skip the export if the GCPs have not changed since the last run
+                gcp_fingerprint = hashlib.blake2b(json.dumps([proj4, gcps], sort_keys=True, default=str).encode('utf-8'), digest_size=16).hexdigest()
+                gcp_fingerprint_file = tree.path("odm_georeferencing", "ground_control_points.fingerprint")
+                previous_fingerprint = None
+                if output_exists(gcp_fingerprint_file):
+                    with open(gcp_fingerprint_file, 'r') as f:
+                        previous_fingerprint = f.read().strip()
+
+                gcp_export_files = [gcp_export_file, gcp_gml_export_file, gcp_geojson_export_file, gcp_geojson_zip_export_file]
+                if previous_fingerprint == gcp_fingerprint and all([output_exists(f) for f in gcp_export_files]):
+                    log.ODM_WARNING("Ground control points have not changed, skipping export")
+                else:
+                    gcp_schema = {
+                        'geometry': 'Point',
+                        'properties': OrderedDict([
+                            ('id', 'str'),
+                            ('observations_count', 'int'),
+                            ('observations_list', 'str'),
+                            ('error_x', 'float'),
+                            ('error_y', 'float'),
+                            ('error_z', 'float'),
+                        ])
+                    }
+
+                    records = [{
+                        'geometry': {
+                            'type': 'Point',
+                            'coordinates': gcp['coordinates'],
+                        },
+                        'properties': OrderedDict([
+                            ('id', gcp['id']),
+                            ('observations_count', len(gcp['observations'])),
+                            ('observations_list', ",".join([obs['shot_id'] for obs in gcp['observations']])),
+                            ('error_x', gcp['error'][0]),
+                            ('error_y', gcp['error'][1]),
+                            ('error_z', gcp['error'][2]),
+                        ])
+                    } for gcp in gcps]
+
+                    gcp_crs = fiona.crs.from_string(proj4)
+
+                    # Write GeoPackage (single transaction, no fsync per record)
+                    with fiona.Env(OGR_SQLITE_SYNCHRONOUS='OFF'):
+                        with fiona.open(gcp_export_file, 'w', driver="GPKG",
+                                        crs=gcp_crs, schema=gcp_schema) as f:
+                            f.writerecords(records)
+
+                    # Write GML
+                    try:
+                        with fiona.open(gcp_gml_export_file, 'w', driver="GML",
+                                        crs=gcp_crs, schema=gcp_schema) as f:
+                            f.writerecords(records)
+                    except Exception as e:
+                        log.ODM_WARNING("Cannot generate ground control points GML file: %s" % str(e))
 
-                # Write GML
-                try:
-                    system.run('ogr2ogr -of GML "{}" "{}"'.format(gcp_gml_export_file, gcp_export_file))
-                except Exception as e:
-                    log.ODM_WARNING("Cannot generate ground control points GML file: %s" % str(e))
+                    # Write GeoJSON
+                    geojson = {
+                        'type': 'FeatureCollection',
+                        'features': []
+                    }
 
-                # Write GeoJSON
-                geojson = {
-                    'type': 'FeatureCollection',
-                    'features': []
-                }
+                    from_srs = reconstruction.georef.srs
+                    to_srs = CRS.from_epsg(4326)
+                    transformer = Transformer.from_crs(from_srs, to_srs, always_xy=True)
 
-                from_srs = CRS.from_proj4(reconstruction.georef.proj4())
-                to_srs = CRS.from_epsg(4326)
-                transformer = location.transformer(from_srs, to_srs)
+                    # Reproject all GCPs with a single call
+                    xs, ys, zs = map(list, zip(*[gcp['coordinates'] for gcp in gcps]))
+                    lons, lats, alts = transformer.transform(xs, ys, zs)
 
-                for gcp in gcps:
-                    properties = gcp.copy()
-                    del properties['coordinates']
+                    for gcp, lon, lat, alt in zip(gcps, lons, lats, alts):
+                        properties = gcp.copy()
+                        del properties['coordinates']
 
-                    geojson['features'].append({
-                        'type': 'Feature',
-                        'geometry': {
-                            'type': 'Point',
-                            'coordinates': transformer.TransformPoint(*gcp['coordinates']),
-                        },
-                        'properties': properties
-                    })
+                        geojson['features'].append({
+                            'type': 'Feature',
+                            'geometry': {
+                                'type': 'Point',
+                                'coordinates': [lon, lat, alt],
+                            },
+                            'properties': properties
+                        })
 
-                with open(gcp_geojson_export_file, 'w') as f:
-                    f.write(json.dumps(geojson, indent=4))
+                    with open(gcp_geojson_export_file, 'w') as f:
+                        f.write(json.dumps(geojson, indent=4))
                 
-                with zipfile.ZipFile(gcp_geojson_zip_export_file, 'w', compression=zipfile.ZIP_LZMA) as f:
-                    f.write(gcp_geojson_export_file, arcname=os.path.basename(gcp_geojson_export_file))
+                    # The zip is embedded in the point cloud, so store
+                    # compact JSON to fit as many GCPs as possible.
+                    # DEFLATE is much faster than LZMA and is comparable on small files,
+                    # use LZMA only if needed to fit in a LAS VLR (65535 bytes)
+                    geojson_compact = json.dumps(geojson, separators=(',', ':'))
+                    for compression, compresslevel in [(zipfile.ZIP_DEFLATED, 6), (zipfile.ZIP_LZMA, None)]:
+                        with zipfile.ZipFile(gcp_geojson_zip_export_file, 'w', compression=compression, compresslevel=compresslevel) as f:
+                            f.writestr(os.path.basename(gcp_geojson_export_file), geojson_compact)
+                        if os.path.getsize(gcp_geojson_zip_export_file) <= 65535:
+                            break
+
+                    with open(gcp_fingerprint_file, 'w') as f:
+                        f.write(gcp_fingerprint)
 
             else:
                 log.ODM_WARNING("GCPs could not be loaded for writing to %s" % gcp_export_file)
 
-        if not io.file_exists(tree.odm_georeferencing_model_laz) or self.rerun():
+        if not output_exists(tree.odm_georeferencing_model_laz) or self.rerun():
             cmd = f'pdal translate -i "{tree.filtered_point_cloud}" -o \"{tree.odm_georeferencing_model_laz}\"'
             stages = ["ferry"]
             params = [
-                '--filters.ferry.dimensions="views => UserData"'
+                '--filters.ferry.dimensions="views => UserData"',
+                '--writers.las.compression=lazperf'
             ]
 
             if reconstruction.is_georeferenced():
@@ -129,24 +174,22 @@ class ODMGeoreferencingStage(types.ODM_Stage):
 
                 # Establish appropriate las scale for export
                 las_scale = 0.001
-                filtered_point_cloud_stats = tree.path("odm_filterpoints", "point_cloud_stats.json")
-                # Function that rounds to the nearest 10
-                # and then chooses the one below so our
-                # las scale is sensible
-                def powerr(r):
-                    return pow(10,round(math.log10(r))) / 10
-
-                if os.path.isfile(filtered_point_cloud_stats):
+                spacing = None
+                if os.path.isfile(tree.filtered_point_cloud_stats):
                     try:
-                        with open(filtered_point_cloud_stats, 'r') as stats:
-                             las_stats = json.load(stats)
-                             spacing = powerr(las_stats['spacing'])
-                             log.ODM_INFO("las scale calculated as the minimum of 1/10 estimated spacing or %s, which ever is less." % las_scale)
-                             las_scale = min(spacing, 0.001)
+                        with open(tree.filtered_point_cloud_stats, 'r') as stats:
+                            spacing = json.load(stats)['spacing']
                     except Exception as e:
-                        log.ODM_WARNING("Cannot find file point_cloud_stats.json. Using default las scale: %s" % las_scale)
+                        log.ODM_WARNING("Cannot read point spacing from %s: %s" % (tree.filtered_point_cloud_stats, str(e)))
+
+                if spacing:
+                    # Round to the nearest power of 10
+                    # and then choose the one below so our
+                    # las scale is sensible
+                    las_scale = min(10 ** (round(math.log10(spacing)) - 1), 0.001)
+                    log.ODM_INFO("las scale calculated as the minimum of 1/10 estimated spacing or 0.001: %s" % las_scale)
                 else:
-                    log.ODM_INFO("No point_cloud_stats.json found. Using default las scale: %s" % las_scale)
+                    log.ODM_INFO("No point spacing estimate found. Using default las scale: %s" % las_scale)
 
                 params += [
                     f'--filters.transformation.matrix="1 0 0 {utmoffset[0]} 0 1 0 {utmoffset[1]} 0 0 1 0 0 0 0 1"',
@@ -156,7 +199,7 @@ class ODMGeoreferencingStage(types.ODM_Stage):
                     f'--writers.las.scale_y={las_scale}',
                     f'--writers.las.scale_z={las_scale}',
                     '--writers.las.offset_z=0',
-                    f'--writers.las.a_srs="{reconstruction.georef.proj4()}"' # HOBU this should maybe be WKT
+                    f'--writers.las.a_srs="{proj4}"' # HOBU this should maybe be WKT
                 ]
 
                 if reconstruction.has_gcp() and io.file_exists(gcp_geojson_zip_export_file):
@@ -210,7 +253,7 @@ class ODMGeoreferencingStage(types.ODM_Stage):
                 shutil.rmtree(stats_dir)
 
             if tree.odm_align_file is not None:
-                alignment_file_exists = io.file_exists(tree.odm_georeferencing_alignment_matrix)
+                alignment_file_exists = output_exists(tree.odm_georeferencing_alignment_matrix)
 
                 if not alignment_file_exists or self.rerun():
                     if alignment_file_exists:
@@ -227,15 +270,21 @@ class ODMGeoreferencingStage(types.ODM_Stage):
 
                         # Align point cloud
                         if os.path.isfile(unaligned_model):
-                            os.rename(unaligned_model, tree.odm_georeferencing_model_laz)
-                        os.rename(tree.odm_georeferencing_model_laz, unaligned_model)
+                            os.replace(unaligned_model, tree.odm_georeferencing_model_laz)
+                        aligning_model = io.related_file_path(tree.odm_georeferencing_model_laz, postfix="_aligning")
 
                         try:
-                            transform_point_cloud(unaligned_model, a_matrix, tree.odm_georeferencing_model_laz)
+                            transform_point_cloud(tree.odm_georeferencing_model_laz, a_matrix, aligning_model)
+                            if not args.optimize_disk_space:
+                                os.replace(tree.odm_georeferencing_model_laz, unaligned_model)
+                            os.replace(aligning_model, tree.odm_georeferencing_model_laz)
                             log.ODM_INFO("Transformed %s" % tree.odm_georeferencing_model_laz)
                         except Exception as e:
                             log.ODM_WARNING("Cannot transform point cloud: %s" % str(e))
-                            os.rename(unaligned_model, tree.odm_georeferencing_model_laz)
+                            if os.path.isfile(aligning_model):
+                                os.unlink(aligning_model)
+                            if not os.path.isfile(tree.odm_georeferencing_model_laz) and os.path.isfile(unaligned_model):
+                                os.replace(unaligned_model, tree.odm_georeferencing_model_laz)
 
                         # Align textured models
                         def transform_textured_model(obj):
@@ -268,7 +317,7 @@ class ODMGeoreferencingStage(types.ODM_Stage):
                         log.ODM_WARNING("Alignment to %s will be skipped." % tree.odm_align_file)
                 else:
                     log.ODM_WARNING("Already computed alignment")
-            elif io.file_exists(tree.odm_georeferencing_alignment_matrix):
+            elif output_exists(tree.odm_georeferencing_alignment_matrix):
                 os.unlink(tree.odm_georeferencing_alignment_matrix)
 
             point_cloud.post_point_cloud_steps(args, tree, self.rerun())
@@ -0,0 +1,94 @@
+import unittest
+import os
+import shutil
+
+import numpy as np
+
+from opendm.align import transform_obj
+
+
+class TestAlign(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists("tests/assets/output"):
+            shutil.rmtree("tests/assets/output")
+        os.makedirs("tests/assets/output")
+
+        self.input_obj = os.path.join("tests/assets/output", "model.obj")
+        self.output_obj = os.path.join("tests/assets/output", "model_aligned.obj")
+
+        # Swap X/Y and translate by (10, 0, 5)
+        self.a_matrix = np.array([
+            [0, 1, 0, 10],
+            [1, 0, 0, 0],
+            [0, 0, 1, 5],
+            [0, 0, 0, 1],
+        ], dtype=float)
+        self.geo_offset = [100, 200]
+
+    def write_obj(self, lines):
+        with open(self.input_obj, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+
+    def read_output(self):
+        with open(self.output_obj, 'r') as f:
+            return f.read().splitlines()
+
+    def test_transform_vertices(self):
+        self.write_obj(["v 1 2 3", "v 4.5 5 6"])
+        transform_obj(self.input_obj, self.a_matrix, self.geo_offset, self.output_obj)
+        out = self.read_output()
+
+        self.assertEqual(len(out), 2)
+        self.assertEqual(out[0].split()[0], "v")
+        np.testing.assert_allclose([float(c) for c in out[0].split()[1:]], [112, -99, 8])
+        np.testing.assert_allclose([float(c) for c in out[1].split()[1:]], [115, -95.5, 11])
+
+    def test_other_lines_unchanged(self):
+        lines = [
+            "# comment",
+            "mtllib model.mtl",
+            "v 1 2 3",
+            "vt 0.1 0.2",
+            "vn 0 0 1",
+            "usemtl material0",
+            "f 1/1/1 1/1/1 1/1/1",
+        ]
+        self.write_obj(lines)
+        transform_obj(self.input_obj, self.a_matrix, self.geo_offset, self.output_obj)
+        out = self.read_output()
+
+        self.assertEqual(len(out), len(lines))
+        for i, line in enumerate(lines):
+            if i != 2:
+                self.assertEqual(out[i], line)
+
+    def test_extra_vertex_components(self):
+        self.write_obj(["v 1 2 3 0.5 0.25 1", "v 4.5 5 6 1.0"])
+        transform_obj(self.input_obj, self.a_matrix, self.geo_offset, self.output_obj)
+        out = self.read_output()
+
+        v1 = out[0].split()
+        np.testing.assert_allclose([float(c) for c in v1[1:4]], [112, -99, 8])
+        self.assertEqual(v1[4:], ["0.5", "0.25", "1"])
+
+        v2 = out[1].split()
+        np.testing.assert_allclose([float(c) for c in v2[1:4]], [115, -95.5, 11])
+        self.assertEqual(v2[4:], ["1.0"])
+
+    def test_no_vertices(self):
+        lines = ["mtllib model.mtl", "vt 0.1 0.2"]
+        self.write_obj(lines)
+        transform_obj(self.input_obj, self.a_matrix, self.geo_offset, self.output_obj)
+        self.assertEqual(self.read_output(), lines)
+
+    def test_blocks(self):
+        lines = ["mtllib model.mtl", "v 1 2 3", "vt 0.1 0.2", "v 4.5 5 6 1.0", "f 1 2 1"]
+        self.write_obj(lines)
+        transform_obj(self.input_obj, self.a_matrix, self.geo_offset, self.output_obj)
+        expected = self.read_output()
+
+        transform_obj(self.input_obj, self.a_matrix, self.geo_offset, self.output_obj, block_size=2)
+        self.assertEqual(self.read_output(), expected)
+
+if __name__ == '__main__':
+    unittest.main()